@@ -1,11 +1,75 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve as sv
 import pandas as pd
 import os
+import shutil
 import yaml
 from datetime import datetime
 import logging
 import sys
+import re
+import csv
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+# Release notes tables live inside 'rnsub' divs and are titled by <h2>
+# headings, so everything else (<head>, scripts, page chrome) is skipped
+# while building the tree.
+RELEASE_NOTES_STRAINER = SoupStrainer(['div', 'h2'])
+RNSUB_CLASS_RE = re.compile('rnsub')
+
+OUTPUT_FORMATS = ('csv', 'feather', 'parquet')
+CSV_CHUNK_SIZE = 10000
+WRITE_BUFFER_SIZE = 1 << 20
+MAX_WRITE_WORKERS = 8
+SMALL_TABLE_ROWS = 1000  # CSV tables below this size are written without pandas
+
+REQUEST_TIMEOUT = (5, 30)  # (connect, read) seconds
+USER_AGENT = "Mozilla/5.0 (compatible; Alma-CKB-Scraper)"
+HTTP_CACHE_NAME = ".http_cache"
+HTTP_CACHE_EXPIRE_AFTER = 3600  # seconds
+
+def create_session():
+    """Creates a pooled HTTP session with keep-alive and retries, cached on disk when requests-cache is installed."""
+    if requests_cache is not None:
+        # Revalidates with ETag/Last-Modified so unchanged pages are not downloaded again
+        session = requests_cache.CachedSession(
+            HTTP_CACHE_NAME,
+            backend='sqlite',
+            cache_control=True,
+            expire_after=HTTP_CACHE_EXPIRE_AFTER
+        )
+    else:
+        session = requests.Session()
+    session.headers.update({'User-Agent': USER_AGENT})
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(total=3, backoff_factor=0.3)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+@functools.lru_cache(maxsize=1)
+def get_session():
+    """Returns the shared HTTP session, creating it on first use (after logging is set up)."""
+    return create_session()
 
 def setup_logging():
     """Sets up logging to both a file and console output."""
@@ -23,8 +87,9 @@ def setup_logging():
     )
     logging.info(f"Logging initialized. Log file: {log_file}")
 
+@functools.lru_cache(maxsize=1)
 def load_config(config_path):
-    """Loads YAML configuration file."""
+    """Loads YAML configuration file (parsed once per path and cached)."""
     try:
         logging.info(f"Loading configuration from {config_path}")
         with open(config_path, 'r') as file:
@@ -42,32 +107,37 @@ def fetch_html(url):
     """Fetches the HTML content of a given URL."""
     logging.info(f"Fetching HTML content from: {url}")
     try:
-        response = requests.get(url)
+        response = get_session().get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         logging.info(f"Successfully fetched content (status code: {response.status_code})")
+        # Pages are UTF-8; setting it up front skips requests' charset detection pass
+        # when the server does not declare a charset
+        if 'charset' not in response.headers.get('Content-Type', '').lower():
+            response.encoding = 'utf-8'
         return response.text
     except requests.RequestException as e:
         logging.error(f"Failed to fetch HTML content: {str(e)}")
         raise
 
-def get_latest_month_url(config):
-    """Finds and returns the latest month's URL from the main page."""
+def compile_link_selectors(config):
+    """Compiles the container and list CSS selectors from the configuration once."""
+    link_selectors = config['urls']['link_selectors']
+    return sv.compile(link_selectors['container']), sv.compile(link_selectors['list'])
+
+def get_latest_month_url(main_url, container_selector, list_selector):
+    """Finds and returns the latest month's URL from the main page using precompiled selectors."""
     try:
-        main_url = config['urls']['main_url']
-        logging.info(f"Accessing main URL: {main_url}")
-        response = requests.get(main_url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(fetch_html(main_url), HTML_PARSER)
         logging.debug("Successfully parsed main page HTML")
         
         # Locate container holding the latest link
-        container = soup.select_one(config['urls']['link_selectors']['container'])
+        container = container_selector.select_one(soup)
         if not container:
             logging.error("Content container not found using selector")
             return None
         
         # Find the latest link inside the container
-        latest_link = container.select_one(config['urls']['link_selectors']['list'])
+        latest_link = list_selector.select_one(container)
         if latest_link and 'href' in latest_link.attrs:
             full_url = latest_link['href']
             logging.info(f"Found latest release notes URL: {full_url}")
@@ -76,96 +146,201 @@ def get_latest_month_url(config):
         logging.error("Could not find latest release notes link")
         return None
     except requests.RequestException as e:
-        logging.error(f"Error accessing main URL: {str(e)}")
+        # fetch_html has already logged the failure
+        logging.debug(f"Error accessing main URL: {str(e)}")
         return None
 
-def extract_tables(html_content, source_url):
-    """Extracts tables from HTML content and returns them in structured format."""
+def map_table_titles(soup):
+    """Maps each table to the text of the nearest preceding <h2> in a single document pass."""
+    table_titles = {}
+    current_title = "Untitled Table"
+    for element in soup.descendants:
+        if element.name == 'h2':
+            current_title = element.get_text().strip()
+        elif element.name == 'table':
+            table_titles[id(element)] = current_title
+    return table_titles
+
+def iter_tables(html_content, source_url):
+    """Parses HTML content eagerly and returns a generator of (table_title, columns) pairs.
+
+    Parsing happens before this returns, so parse failures surface before any output is touched;
+    only the per-table extraction is lazy. columns maps each header, plus the
+    week_info/source_url/table_title metadata, to its list of values.
+    """
     logging.info("Beginning table extraction")
-    soup = BeautifulSoup(html_content, 'html.parser')
-    rnsub_divs = soup.find_all('div', class_=lambda x: x and 'rnsub' in x)
+    soup = BeautifulSoup(html_content, HTML_PARSER, parse_only=RELEASE_NOTES_STRAINER)
+    table_titles = map_table_titles(soup)
+    rnsub_divs = soup.find_all('div', class_=RNSUB_CLASS_RE)
     logging.info(f"Found {len(rnsub_divs)} rnsub divisions")
-    extracted_tables = []
+    return generate_tables(soup, table_titles, rnsub_divs, source_url)
+
+def generate_tables(soup, table_titles, rnsub_divs, source_url):
+    """Yields (table_title, columns) pairs from parsed rnsub divisions as each table is completed."""
+    extracted_count = 0
+    total_rows = 0
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
     
-    for idx, div in enumerate(rnsub_divs, 1):
-        logging.debug(f"Processing division {idx}/{len(rnsub_divs)}")
-        week_info = div.find('span', class_='AlmaRNTag')
-        week_info = week_info.text.strip() if week_info else "Unknown Week"
-        tables = div.find_all('table')
-        
-        for table_idx, table in enumerate(tables, 1):
-            try:
-                # Locate table title
-                title_element = table.find_previous('h2')
-                table_title = title_element.text.strip() if title_element else "Untitled Table"
-                
-                # Extract headers
-                headers = [th.text.strip() for th in table.find_all('th')]
-                rows = table.find_all('tr')[1:]  # Skip header row
-                table_data = []
-                
-                for row in rows:
-                    cells = [cell.text.strip() for cell in row.find_all('td')]
-                    row_data = {headers[i]: cells[i] for i in range(len(headers))}
-                    row_data.update({'week_info': week_info, 'source_url': source_url, 'table_title': table_title})
-                    table_data.append(row_data)
+    try:
+        for idx, div in enumerate(rnsub_divs, 1):
+            if debug_enabled:
+                logging.debug("Processing division %d/%d", idx, len(rnsub_divs))
+            week_info = div.find('span', class_='AlmaRNTag')
+            week_info = week_info.get_text().strip() if week_info else "Unknown Week"
+            tables = div.find_all('table')
+            
+            for table_idx, table in enumerate(tables, 1):
+                try:
+                    # Locate table title
+                    table_title = table_titles[id(table)]
+                    
+                    # Traverse the rows once: the first row holds the headers (<th> or <td>)
+                    all_rows = table.find_all('tr')
+                    header_cells = all_rows[0].find_all(['th', 'td']) if all_rows else []
+                    headers = [cell.get_text().strip() for cell in header_cells]
+                    rows = all_rows[1:]
+                    columns = [[] for _ in headers]
+                    
+                    # Fill column lists directly rather than building a dict per row
+                    for row in rows:
+                        cells = row.find_all(['th', 'td'])
+                        for i, column in enumerate(columns):
+                            column.append(cells[i].get_text().strip())
+                    
+                    row_count = len(rows)
+                    table_data = dict(zip(headers, columns))
+                    table_data['week_info'] = [week_info] * row_count
+                    table_data['source_url'] = [source_url] * row_count
+                    table_data['table_title'] = [table_title] * row_count
+                except Exception as e:
+                    logging.error("Error processing table %d in division %d: %s", table_idx, idx, e)
+                    continue
                 
-                extracted_tables.append({'headers': headers + ['week_info', 'source_url', 'table_title'], 'rows': table_data, 'table_title': table_title})
-            except Exception as e:
-                logging.error(f"Error processing table {table_idx}: {str(e)}")
+                extracted_count += 1
+                total_rows += row_count
+                if debug_enabled:
+                    logging.debug("Extracted table '%s' with %d rows", table_title, row_count)
+                yield table_title, table_data
+    finally:
+        # Extracted values are plain strings, so the parse tree can be released now
+        # instead of waiting for the cyclic garbage collector to reclaim it
+        soup.decompose()
     
-    logging.info(f"Completed table extraction. Total tables extracted: {len(extracted_tables)}")
-    return extracted_tables
+    logging.info("Completed table extraction. Total tables extracted: %d (%d rows)", extracted_count, total_rows)
 
 def manage_output_folders(base_dir):
     """Manages output directories, rotating 'current' data to 'last time'."""
     current_dir = os.path.join(base_dir, "current")
     last_time_dir = os.path.join(base_dir, "last time")
+    previous_dir = os.path.join(base_dir, "last time.old")
+    # Recover from an interrupted rotation: restore 'last time' if it went missing,
+    # otherwise the leftover copy is stale
+    if os.path.exists(previous_dir):
+        if os.path.exists(last_time_dir):
+            shutil.rmtree(previous_dir)
+        else:
+            os.rename(previous_dir, last_time_dir)
     os.makedirs(current_dir, exist_ok=True)
     os.makedirs(last_time_dir, exist_ok=True)
 
     if os.listdir(current_dir):
         logging.info("Moving current files to last time directory")
-        for file_name in os.listdir(current_dir):
-            source_path = os.path.join(current_dir, file_name)
-            destination_path = os.path.join(last_time_dir, file_name)
+        # Swap whole directories with renames, keeping the old 'last time' until the swap succeeds
+        os.rename(last_time_dir, previous_dir)
+        try:
+            os.rename(current_dir, last_time_dir)
+        except OSError:
+            try:
+                os.rename(previous_dir, last_time_dir)
+            except OSError as restore_error:
+                logging.error(f"Could not restore previous 'last time' directory from {previous_dir}: {restore_error}")
+            raise
+        os.makedirs(current_dir)
+        shutil.rmtree(previous_dir)
 
-            # Check if the file already exists in 'last_time' and delete it
-            if os.path.exists(destination_path):
-                os.remove(destination_path)
+def write_table(table_data, filename, file_format):
+    """Writes a single table of column lists to disk in the requested format."""
+    row_count = len(next(iter(table_data.values()), []))
+    if file_format == 'csv' and row_count < SMALL_TABLE_ROWS:
+        # Small tables are dominated by DataFrame overhead, so write the rows directly
+        with open(filename, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as file:
+            writer = csv.writer(file, lineterminator=os.linesep)
+            writer.writerow(table_data.keys())
+            writer.writerows(zip(*table_data.values()))
+        return
+    
+    df = pd.DataFrame(table_data)
+    if file_format == 'feather':
+        df.to_feather(filename)
+    elif file_format == 'parquet':
+        df.to_parquet(filename, compression='zstd')
+    else:
+        with open(filename, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as file:
+            df.to_csv(file, index=False, chunksize=CSV_CHUNK_SIZE)
 
-            # Move (rename) the file
-            os.rename(source_path, destination_path)    
+def save_table(idx, table_title, table_data, output_dir, file_format):
+    """Saves one extracted table and reports whether it was written."""
+    try:
+        filename = os.path.join(output_dir, f"table_{idx}.{file_format}")
+        write_table(table_data, filename, file_format)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Saved table '%s' to %s", table_title, filename)
+        return True
+    except Exception as e:
+        logging.error("Error saving table %d: %s", idx, e)
+        return False
+
+def validate_output_format(file_format):
+    """Checks that the output format is supported and that its writer dependency is installed."""
+    if file_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {file_format}")
+    if file_format in ('feather', 'parquet'):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logging.error(f"Output format '{file_format}' requires pyarrow, which is not installed")
+            raise
 
-def save_tables(extracted_tables, output_dir):
-    """Saves extracted tables as CSV files."""
+def save_tables(tables, output_dir, file_format='csv'):
+    """Saves (table_title, columns) pairs as CSV (default), Feather or Parquet files as they arrive, writing them in parallel."""
+    validate_output_format(file_format)
     logging.info(f"Saving tables to directory: {output_dir}")
     os.makedirs(output_dir, exist_ok=True)
     
-    for idx, table in enumerate(extracted_tables, 1):
-        try:
-            df = pd.DataFrame(table['rows'])
-            filename = os.path.join(output_dir, f"table_{idx}.csv")
-            df.to_csv(filename, index=False)
-            logging.info(f"Saved table '{table['table_title']}' to {filename}")
-        except Exception as e:
-            logging.error(f"Error saving table {idx}: {str(e)}")
+    # Tables are independent, so disk writes can overlap across worker threads.
+    # At most MAX_WRITE_WORKERS tables are in flight: once the window is full the
+    # producer waits for the oldest write before extracting the next table.
+    results = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=MAX_WRITE_WORKERS) as executor:
+        for idx, (table_title, table_data) in enumerate(tables, 1):
+            if len(pending) >= MAX_WRITE_WORKERS:
+                results.append(pending.popleft().result())
+            pending.append(executor.submit(save_table, idx, table_title, table_data, output_dir, file_format))
+        results.extend(future.result() for future in pending)
+    
+    logging.info("Successfully saved %d out of %d tables", sum(results), len(results))
 
 def main():
     """Main execution function handling all operations."""
     try:
         setup_logging()
         config = load_config("config.yaml")
-        latest_url = get_latest_month_url(config)
+        container_selector, list_selector = compile_link_selectors(config)
+        latest_url = get_latest_month_url(config['urls']['main_url'], container_selector, list_selector)
         if not latest_url:
             logging.error("Could not retrieve the latest month URL. Exiting.")
             return
         
         html_content = fetch_html(latest_url)
-        tables = extract_tables(html_content, latest_url)
+        # Parse before rotating folders so a bad page leaves previous output untouched
+        tables = iter_tables(html_content, latest_url)
         base_output_dir = r"C:\Users\masedet\Tel-Aviv University\masedet - Documents\Data\CKB"
+        output_format = 'csv'
+        # Validate before rotating folders so a bad format leaves previous output untouched
+        validate_output_format(output_format)
         manage_output_folders(base_output_dir)
-        save_tables(tables, os.path.join(base_output_dir, "current"))
+        save_tables(tables, os.path.join(base_output_dir, "current"), output_format)
         logging.info("Web scraping process completed successfully")
     except Exception as e:
         logging.critical(f"Critical error in main process: {str(e)}", exc_info=True)